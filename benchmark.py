@@ -0,0 +1,338 @@
+"""Benchmarks Git Bridge's hot paths against generated repositories of a chosen size.
+
+    python benchmark.py --size medium --output results.json
+    python benchmark.py --size medium --gui --compare results.json
+
+Repositories are generated once with `git fast-import` and reused from the user
+cache directory. Without --gui only the git_core engine is timed; with --gui a
+Tk root is created (it needs a display, e.g. `xvfb-run python benchmark.py --gui`)
+and the same operations are timed through GitApp, including the time Tk spends
+showing the result. Results are written as JSON; --compare reports every benchmark
+whose median got slower than --threshold and exits with status 1 if any did.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+
+from git_core import (
+    DIFF_TREE_ARGS, HISTORY_FORMAT, HISTORY_PAGE_SIZE, CommitGraph, GitOutputStream, GitRepoReader,
+    history_cache_path, parse_commit_query, parse_commit_record, parse_diff_tree, parse_status_v2, popen_git,
+    read_branches, status_args, user_cache_dir,
+)
+
+# Repository shapes; any field can be overridden on the command line
+SIZES = {
+    "small": dict(commits=1_000, files=1_000, branches=50, changed=100, diff_lines=5_000),
+    "medium": dict(commits=20_000, files=20_000, branches=1_000, changed=2_000, diff_lines=50_000),
+    "large": dict(commits=100_000, files=100_000, branches=5_000, changed=10_000, diff_lines=200_000),
+}
+# Messages written per run of the log throughput benchmark
+LOG_MESSAGES = 20_000
+# Files per directory in generated repositories
+FILES_PER_DIR = 100
+# Give up on a GUI benchmark that hasn't finished after this many seconds
+GUI_TIMEOUT = 300.0
+# Increase in median time, as a fraction, that --compare reports as a regression
+REGRESSION_THRESHOLD = 0.10
+# Bumped when the generated repositories change shape, so stale ones are rebuilt
+GENERATOR_VERSION = 1
+
+
+def git(args, cwd, **kwargs):
+    return subprocess.run(["git"] + args, cwd=cwd, check=True, capture_output=True, text=True, **kwargs).stdout
+
+
+def file_path(index):
+    return f"dir{index // FILES_PER_DIR:05d}/file{index:06d}.txt"
+
+
+def generate_repository(path, commits, files, branches, changed, diff_lines):
+    """Creates a repository with the given number of commits, files, branches and uncommitted changes.
+
+    The last commit rewrites one file with `diff_lines` lines so there is a large diff to show.
+    """
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    git(["init", "-q", "-b", "main"], path)
+    process = subprocess.Popen(["git", "fast-import", "--quiet"], cwd=path, stdin=subprocess.PIPE)
+    write = process.stdin.write
+
+    def blob(text):
+        data = text.encode()
+        write(b"data %d\n%s\n" % (len(data), data))
+
+    def commit(mark, message, changes):
+        write(b"commit refs/heads/main\nmark :%d\n" % mark)
+        write(b"author Bench <bench@example.com> %d +0000\n" % (1_600_000_000 + mark * 60))
+        write(b"committer Bench <bench@example.com> %d +0000\n" % (1_600_000_000 + mark * 60))
+        blob(message)
+        for name, text in changes:
+            write(f"M 100644 inline {name}\n".encode())
+            blob(text)
+
+    commit(1, "Initial import", [(file_path(i), f"file {i}\n") for i in range(files)])
+    for mark in range(2, commits):
+        index = (mark * 7919) % files  # Spread the edits over the tree
+        commit(mark, f"Change {file_path(index)} (commit {mark})", [(file_path(index), f"file {index}\nedit {mark}\n")])
+    commit(commits, "Rewrite the big file", [("big.txt", "".join(f"line {i}\n" for i in range(diff_lines)))])
+    for branch in range(branches):
+        write(f"reset refs/heads/branch-{branch:05d}\nfrom :{max(1, commits - branch * 13 % commits)}\n\n".encode())
+    process.stdin.close()
+    if process.wait() != 0:
+        raise RuntimeError("git fast-import failed")
+
+    git(["reset", "-q", "--hard", "main"], path)
+    for index in range(changed):
+        name = os.path.join(path, file_path(index * files // changed))
+        with open(name, "a", encoding="utf-8") as f:
+            f.write("uncommitted\n")
+    for index in range(changed // 10):
+        with open(os.path.join(path, f"untracked{index}.txt"), "w", encoding="utf-8") as f:
+            f.write("new\n")
+
+
+def benchmark_repository(shape, rebuild=False):
+    """Returns the path of a generated repository of this shape, generating it if needed."""
+    key = "-".join(f"{name}{shape[name]}" for name in sorted(shape))
+    path = os.path.join(user_cache_dir(), "benchmarks", f"v{GENERATOR_VERSION}-{key}")
+    marker = os.path.join(path, ".git", "benchmark-complete")
+    if rebuild or not os.path.exists(marker):
+        print(f"Generating {path} ...", file=sys.stderr, flush=True)
+        started = time.perf_counter()
+        generate_repository(path, **shape)
+        open(marker, "w").close()
+        print(f"Generated in {time.perf_counter() - started:.1f} s", file=sys.stderr, flush=True)
+    return path
+
+
+def read_all(stream, page=HISTORY_PAGE_SIZE):
+    lines = []
+    while not stream.exhausted:
+        lines.extend(stream.read_page(page))
+    return lines
+
+
+def headless_benchmarks(repo):
+    """Returns {name: function} timing the engine the GUI runs on its worker threads."""
+    head = git(["rev-parse", "HEAD"], repo).strip()
+
+    def status():
+        process = popen_git(status_args(), repo, write=False, encoding="utf-8", errors="replace")
+        parse_status_v2(process.communicate()[0])
+
+    def history_first_page():
+        stream = GitOutputStream(["log", "--topo-order", "--all", "--format=" + HISTORY_FORMAT], repo)
+        graph = CommitGraph([parse_commit_record(line) for line in stream.read_page(HISTORY_PAGE_SIZE)])
+        for row in range(min(len(graph), 60)):
+            graph.graph(row)
+        stream.close()
+
+    def history_full():
+        stream = GitOutputStream(["log", "--topo-order", "--all", "--format=" + HISTORY_FORMAT], repo)
+        graph = CommitGraph([parse_commit_record(line) for line in read_all(stream)])
+        graph.graph(len(graph) - 1)
+
+    loaded = []
+
+    def history_search():
+        if not loaded:  # Index once, outside the timed part of later runs
+            stream = GitOutputStream(["log", "--topo-order", "--all", "--format=" + HISTORY_FORMAT], repo)
+            loaded.append(CommitGraph([parse_commit_record(line) for line in read_all(stream)]))
+        for text in ("change", "author:bench", "file0001", "after:2020-09-14 before:2020-09-20", head[:8]):
+            loaded[0].index.search(parse_commit_query(text))
+
+    def diff_files():
+        process = popen_git(DIFF_TREE_ARGS + ["--raw", "--numstat", "-z", head], repo, write=False)
+        parse_diff_tree(process.communicate()[0])
+
+    def diff_patch():
+        read_all(GitOutputStream(DIFF_TREE_ARGS + ["-p", head, "--", "big.txt"], repo))
+
+    def branches_reader():
+        GitRepoReader(repo).branches()
+
+    def branches_git():
+        read_branches(repo)
+
+    def log_sink():
+        from git2 import LogSink  # Imports Tk, but creates no window
+        sink = LogSink(None)
+        for index in range(LOG_MESSAGES):
+            sink.write(f"message {index}\nwith a second line")
+
+    return {
+        "status": status, "history_first_page": history_first_page, "history_full": history_full,
+        "history_search": history_search,
+        "diff_files": diff_files, "diff_patch": diff_patch, "branches_reader": branches_reader,
+        "branches_git": branches_git, "log_write": log_sink,
+    }
+
+
+def gui_benchmarks(repo):
+    """Returns {name: function} timing GitApp itself, up to the point the result is on screen."""
+    import ttkbootstrap as tb
+    from git2 import GitApp
+
+    root = tb.Window(themename="cosmo")
+    root.withdraw()
+    app = GitApp(root)
+    app.repo_path.set(repo)
+    head = git(["rev-parse", "HEAD"], repo).strip()
+
+    def pump(done):
+        deadline = time.monotonic() + GUI_TIMEOUT
+        while not done():
+            if time.monotonic() > deadline:
+                raise TimeoutError("GUI benchmark timed out")
+            root.update()
+            time.sleep(0.001)
+        root.update_idletasks()
+
+    def status():
+        # A full refresh, without update_status()'s debounce delay
+        app.last_refresh_ms = None
+        app._refresh_full = True
+        app.refresh_status()
+        pump(lambda: app.last_refresh_ms is not None and not app.executor.pending())
+
+    def history(cached):
+        def run():
+            if not cached:
+                try:
+                    os.remove(history_cache_path(repo))
+                except OSError:
+                    pass
+            app.show_history(None, None, CommitGraph())
+            app._history_ref_snapshot = None
+            app.update_commit_history()
+            pump(lambda: len(app.history) > 0 and not app._history_loading and not app.executor.pending())
+        return run
+
+    def diff():
+        window = None
+
+        def opened():
+            return window is not None and len(window.files) > 0 and not app.executor.pending()
+
+        app.diff_cache.clear()
+        from git2 import DiffWindow
+        window = DiffWindow(app, head)
+        pump(opened)
+        window.show_file(next(change for change in window.files if change.path == "big.txt"), force=True)
+        pump(lambda: window.stream is None and not app.executor.pending())
+        window.close()
+
+    def branches():
+        found = []
+        app._branch_cache = None
+        app.load_branches(found.append)
+        pump(lambda: found)
+
+    def log():
+        for index in range(LOG_MESSAGES):
+            app.log(f"message {index}\nwith a second line")
+        app.log_sink.flush()
+        root.update_idletasks()
+
+    benchmarks = {
+        "gui_status": status, "gui_history_cold": history(False), "gui_history_cached": history(True),
+        "gui_diff": diff, "gui_branches": branches, "gui_log": log,
+    }
+    return benchmarks, lambda: (app.shutdown(), root.destroy())
+
+
+def run_benchmarks(benchmarks, repeat):
+    results = {}
+    for name, function in benchmarks.items():
+        function()  # Warm-up: caches, imports and the OS page cache
+        runs = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            function()
+            runs.append((time.perf_counter() - started) * 1000)
+        runs.sort()
+        results[name] = {"runs_ms": [round(run, 3) for run in runs], "min_ms": round(runs[0], 3),
+                         "median_ms": round(runs[len(runs) // 2], 3), "max_ms": round(runs[-1], 3)}
+        print(f"{name:24} median {results[name]['median_ms']:10.1f} ms   min {results[name]['min_ms']:10.1f} ms",
+              file=sys.stderr, flush=True)
+    return results
+
+
+def compare(baseline, current, threshold):
+    """Prints the change in median per benchmark; returns the names that regressed beyond `threshold`."""
+    regressions = []
+    for name, result in current["results"].items():
+        old = baseline.get("results", {}).get(name)
+        if old is None:
+            print(f"{name:24} new")
+            continue
+        change = result["median_ms"] / old["median_ms"] - 1 if old["median_ms"] else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:24} {old['median_ms']:10.1f} -> {result['median_ms']:10.1f} ms  {change:+7.1%}{flag}")
+    if baseline.get("shape") != current["shape"]:
+        print("Note: the baseline was measured on a different repository shape.")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--size", choices=SIZES, default="small")
+    for field in SIZES["small"]:
+        parser.add_argument(f"--{field.replace('_', '-')}", type=int, dest=field, help=f"override {field}")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per benchmark (default 5)")
+    parser.add_argument("--gui", action="store_true", help="also time GitApp with a real Tk root")
+    parser.add_argument("--only", action="append", metavar="NAME", help="run only these benchmarks")
+    parser.add_argument("--rebuild", action="store_true", help="regenerate the repository")
+    parser.add_argument("--output", help="write results to this JSON file (default: stdout)")
+    parser.add_argument("--compare", metavar="BASELINE", help="compare against an earlier results file")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    options = parser.parse_args(argv)
+
+    shape = dict(SIZES[options.size])
+    shape.update({field: getattr(options, field) for field in shape if getattr(options, field) is not None})
+    repo = benchmark_repository(shape, options.rebuild)
+
+    benchmarks = headless_benchmarks(repo)
+    close = None
+    if options.gui:
+        gui, close = gui_benchmarks(repo)
+        benchmarks.update(gui)
+    if options.only:
+        benchmarks = {name: function for name, function in benchmarks.items() if name in options.only}
+    try:
+        results = run_benchmarks(benchmarks, options.repeat)
+    finally:
+        if close is not None:
+            close()
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "shape": shape, "repeat": options.repeat,
+        "git": git(["--version"], repo).strip(), "python": platform.python_version(),
+        "platform": platform.platform(), "results": results,
+    }
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if options.compare:
+        with open(options.compare, "r", encoding="utf-8") as f:
+            regressions = compare(json.load(f), report, options.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) regressed: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
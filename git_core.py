@@ -0,0 +1,2136 @@
+"""Git Bridge core: running git, reading repositories and the workspace/clone engine.
+
+Nothing in here imports Tk, so the same code backs the GUI in git2.py and the
+command line (`python git_core.py --help`), and loads quickly on its own.
+"""
+import argparse
+import bisect
+import contextlib
+import ctypes
+import ctypes.util
+import hashlib
+import itertools
+import json
+import os
+import queue
+import re
+import select
+import shlex
+import struct
+import subprocess
+import sys
+import threading
+import time
+from array import array
+from collections import deque, namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# subprocess.CREATE_NO_WINDOW only exists on Windows
+CREATE_NO_WINDOW = getattr(subprocess, "CREATE_NO_WINDOW", 0)
+
+# Commands that never modify the repository and can safely run side by side
+READ_ONLY_COMMANDS = frozenset({
+    "status", "log", "show", "diff", "rev-parse", "rev-list", "for-each-ref",
+    "ls-files", "ls-tree", "cat-file", "describe", "shortlog", "blame",
+    "show-ref", "merge-base",
+})
+# `git branch` / `git remote` flags that only list things
+LISTING_FLAGS = frozenset({"-a", "-r", "-v", "-vv", "--all", "--remotes", "--list", "--verbose"})
+
+
+def is_read_only(args):
+    """Returns True if the git command only reads from the repository."""
+    while len(args) >= 2 and args[0] == "-c":
+        args = args[2:]  # Skip `-c key=value` overrides
+    if not args:
+        return False
+    if args[0] in READ_ONLY_COMMANDS:
+        return True
+    if args[0] in ("branch", "remote"):
+        return all(arg in LISTING_FLAGS for arg in args[1:])
+    return False
+
+
+# Git writes paths and names as UTF-8 whatever the locale (cp1252 on Windows). Invalid bytes
+# become surrogates, which encode back to the same bytes when a path is handed to git again.
+GIT_ENCODING = "utf-8"
+GIT_ERRORS = "surrogateescape"
+
+
+def popen_git(args, cwd, write=True, extra_env=None, **kwargs):
+    """Starts `git <args>` with piped output and no console window.
+
+    Text mode pipes use GIT_ENCODING and GIT_ERRORS unless told otherwise.
+    """
+    env = dict(extra_env) if extra_env else {}
+    if not write:
+        # Keep read-only commands from taking index.lock while a write is in flight
+        env["GIT_OPTIONAL_LOCKS"] = "0"
+    env = dict(os.environ, **env) if env else None
+    kwargs.setdefault("text", True)
+    if kwargs["text"]:
+        kwargs.setdefault("encoding", GIT_ENCODING)
+        kwargs.setdefault("errors", GIT_ERRORS)
+    kwargs.setdefault("stdin", subprocess.DEVNULL)
+    kwargs.setdefault("stdout", subprocess.PIPE)
+    kwargs.setdefault("stderr", subprocess.PIPE)
+    return subprocess.Popen(
+        ["git"] + args,
+        cwd=cwd,
+        env=env,
+        creationflags=CREATE_NO_WINDOW,
+        **kwargs
+    )
+
+
+# Timing spans kept for the Performance tab and trace export; older ones are dropped
+PERF_MAX_SPANS = 20000
+# Upper bounds (ms) of the duration histogram buckets; the last bucket is open-ended
+PERF_HISTOGRAM_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+Span = namedtuple("Span", "name category start duration wait size returncode thread")
+
+
+def command_name(args):
+    """Returns the name a git command is grouped under, e.g. "git status"."""
+    while len(args) >= 2 and args[0] == "-c":
+        args = args[2:]
+    return "git " + args[0] if args else "git"
+
+
+class PerfRecorder:
+    """Collects timing spans from any thread: git commands, background tasks and UI work.
+
+    Times are time.perf_counter() seconds. `wait` is how long a command sat in the
+    executor's queue before it started, and `size` how much output it produced
+    (characters of decoded stdout, which is bytes for ASCII output).
+    """
+
+    def __init__(self, max_spans=PERF_MAX_SPANS):
+        self.origin = time.perf_counter()
+        self._spans = deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+
+    def add(self, name, category, start, duration, wait=0.0, size=None, returncode=None):
+        span = Span(name, category, start, duration, wait, size, returncode, threading.current_thread().name)
+        with self._lock:
+            self._spans.append(span)
+
+    @contextlib.contextmanager
+    def span(self, name, category="ui"):
+        """Records the time spent in the `with` block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, category, start, time.perf_counter() - start)
+
+    def spans(self, category=None):
+        with self._lock:
+            spans = list(self._spans)
+        return spans if category is None else [span for span in spans if span.category == category]
+
+    def clear(self):
+        with self._lock:
+            self._spans.clear()
+
+    def by_name(self, category=None):
+        """Returns [(name, count, total s, max s, total wait s, total bytes)], biggest total first."""
+        totals = {}
+        for span in self.spans(category):
+            count, total, longest, wait, size = totals.get(span.name, (0, 0.0, 0.0, 0.0, 0))
+            totals[span.name] = (count + 1, total + span.duration, max(longest, span.duration),
+                                 wait + span.wait, size + (span.size or 0))
+        return sorted(((name,) + values for name, values in totals.items()), key=lambda row: -row[2])
+
+    def slowest(self, count, category=None):
+        return sorted(self.spans(category), key=lambda span: -span.duration)[:count]
+
+    def histogram(self, category=None, edges=PERF_HISTOGRAM_MS):
+        """Returns how many spans fall into each duration bucket; one more bucket than `edges`."""
+        counts = [0] * (len(edges) + 1)
+        for span in self.spans(category):
+            ms = span.duration * 1000
+            counts[next((i for i, edge in enumerate(edges) if ms < edge), len(edges))] += 1
+        return counts
+
+    def chrome_trace(self):
+        """Returns the spans as Chrome trace-event JSON (chrome://tracing, Perfetto)."""
+        pid = os.getpid()
+        threads = {}
+        events = []
+        for span in self.spans():
+            tid = threads.setdefault(span.thread, len(threads) + 1)
+            args = {"wait_ms": round(span.wait * 1000, 3)}
+            if span.size is not None:
+                args["bytes"] = span.size
+            if span.returncode is not None:
+                args["returncode"] = span.returncode
+            events.append({"name": span.name, "cat": span.category, "ph": "X", "pid": pid, "tid": tid,
+                           "ts": round((span.start - self.origin) * 1e6, 1), "dur": round(span.duration * 1e6, 1),
+                           "args": args})
+        for thread, tid in threads.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": thread}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save_chrome_trace(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.chrome_trace(), f)
+
+
+# Every git command and timed UI phase in this process ends up here
+perf_recorder = PerfRecorder()
+
+
+class GitCommand:
+    """A single queued git invocation (or background task) and its outcome."""
+
+    def __init__(self, command_id, args, cwd, write, callback, description, task=None):
+        self.id = command_id
+        self.args = args
+        self.cwd = cwd
+        self.write = write
+        self.callback = callback
+        self.description = description or "git " + " ".join(args)
+        self.task = task
+        self.result = None
+        self.future = None
+        self.process = None
+        self.cancelled = False
+        self.returncode = None
+        self.stdout = ""
+        self.stderr = ""
+        self.error = None
+        # perf_counter() times, for the recorder
+        self.submitted = time.perf_counter()
+        self.started = None
+        self.finished = None
+
+    @property
+    def ok(self):
+        if self.task is not None:
+            return not self.cancelled and self.error is None
+        return not self.cancelled and self.error is None and self.returncode == 0
+
+
+class GitCommandExecutor:
+    """Runs git commands off the Tk thread and hands results back through master.after.
+
+    Read-only commands run concurrently on a worker pool. Commands that modify the
+    repository (commit, checkout, push, ...) go through a single worker so they never
+    race each other.
+    """
+
+    def __init__(self, master, max_workers=4, poll_interval=50, recorder=perf_recorder):
+        self.master = master
+        self.recorder = recorder
+        self.poll_interval = poll_interval
+        self._read_pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="git-read")
+        self._write_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="git-write")
+        self._results = queue.Queue()
+        self._pending = {}
+        self._ids = itertools.count(1)
+        self._polling = False
+        self.on_change = None  # Called on the Tk thread whenever the pending set changes
+
+    def submit(self, args, cwd, callback=None, write=None, description=None):
+        """Queues `git <args>` and returns the GitCommand handle."""
+        if write is None:
+            write = not is_read_only(args)
+        command = GitCommand(next(self._ids), list(args), cwd, write, callback, description)
+        self._pending[command.id] = command
+        pool = self._write_pool if write else self._read_pool
+        command.future = pool.submit(self._execute, command)
+        self._schedule_drain()
+        self._notify()
+        return command
+
+    def submit_task(self, task, callback=None, description=None, write=False):
+        """Runs a Python callable in the background; its return value ends up in `result`.
+
+        Tasks that modify the repository pass `write` to queue behind other writes.
+        """
+        command = GitCommand(next(self._ids), None, None, write, callback, description or "background task", task)
+        self._pending[command.id] = command
+        pool = self._write_pool if write else self._read_pool
+        command.future = pool.submit(self._execute, command)
+        self._schedule_drain()
+        self._notify()
+        return command
+
+    def cancel(self, command_id):
+        """Cancels a queued or running command. Its callback still fires, with cancelled set."""
+        command = self._pending.get(command_id)
+        if command is None:
+            return
+        command.cancelled = True
+        if command.future.cancel():
+            # Never started, so no worker will report back for it
+            del self._pending[command.id]
+            self._dispatch(command)
+            self._notify()
+            return
+        process = command.process
+        if process is not None and process.poll() is None:
+            process.terminate()
+
+    def cancel_all(self):
+        for command_id in list(self._pending):
+            self.cancel(command_id)
+
+    def pending(self):
+        """Returns the queued and running commands, oldest first."""
+        return list(self._pending.values())
+
+    def shutdown(self):
+        # The UI is going away, so don't call back into it
+        self.on_change = None
+        for command in self._pending.values():
+            command.callback = None
+        self.cancel_all()
+        self._read_pool.shutdown(wait=False, cancel_futures=True)
+        self._write_pool.shutdown(wait=False, cancel_futures=True)
+
+    def _execute(self, command):
+        # Runs on a worker thread: no Tk calls allowed here
+        command.started = time.perf_counter()
+        try:
+            if command.cancelled:
+                return
+            if command.task is not None:
+                command.result = command.task()
+                return
+            command.process = popen_git(command.args, command.cwd, write=command.write)
+            if command.cancelled:
+                command.process.terminate()
+            command.stdout, command.stderr = command.process.communicate()
+            command.returncode = command.process.returncode
+        except Exception as e:
+            # Git missing, output that won't decode or a failing task: reported to the
+            # callback through `error`, since nobody looks at the future
+            command.error = e
+        finally:
+            command.finished = time.perf_counter()
+            self._record(command)
+            self._results.put(command)
+
+    def _record(self, command):
+        # Runs on the worker thread, so the span shows up on that thread in a trace
+        if self.recorder is None or command.cancelled:
+            return
+        wait = command.started - command.submitted
+        duration = command.finished - command.started
+        if command.task is not None:
+            self.recorder.add(command.description, "task", command.started, duration, wait)
+        elif command.process is not None:
+            self.recorder.add(command_name(command.args), "git", command.started, duration, wait,
+                              len(command.stdout or ""), command.returncode)
+
+    def _schedule_drain(self):
+        if not self._polling:
+            self._polling = True
+            self.master.after(self.poll_interval, self._drain)
+
+    def _drain(self):
+        changed = False
+        while True:
+            try:
+                command = self._results.get_nowait()
+            except queue.Empty:
+                break
+            if self._pending.pop(command.id, None) is not None:
+                changed = True
+                self._dispatch(command)
+        if changed:
+            self._notify()
+        if self._pending:
+            self.master.after(self.poll_interval, self._drain)
+        else:
+            self._polling = False
+
+    def _dispatch(self, command):
+        if command.callback is None:
+            return
+        if self.recorder is None:
+            command.callback(command)
+            return
+        with self.recorder.span("callback: " + command.description):
+            command.callback(command)
+
+    def _notify(self):
+        if self.on_change is not None:
+            self.on_change()
+
+
+class GitOutputStream:
+    """Reads the output of a long-running git command (log, diff) incrementally.
+
+    The process is started on the first read and pages are pulled from its pipe on
+    demand, so git is paused by pipe back-pressure while nobody is scrolling.
+    """
+
+    def __init__(self, args, cwd):
+        self.args = args
+        self.cwd = cwd
+        self.exhausted = False
+        self._process = None
+        self._closed = False
+        self._reading = False
+        self._lock = threading.Lock()
+        self._started = None
+        self._size = 0
+
+    def read_page(self, count):
+        """Returns up to `count` more lines. Runs on a worker thread."""
+        with self._lock:
+            if self._closed or self.exhausted:
+                return []
+            if self._process is None:
+                self._started = time.perf_counter()
+                self._process = popen_git(self.args, self.cwd, write=False, stderr=subprocess.DEVNULL,
+                                          encoding="utf-8", errors="replace")
+            self._reading = True
+        stdout = self._process.stdout
+        lines = []
+        for _ in range(count):
+            line = stdout.readline()
+            if not line:
+                self.exhausted = True
+                break
+            self._size += len(line)
+            lines.append(line.rstrip("\n"))
+        with self._lock:
+            self._reading = False
+            if self._closed or self.exhausted:
+                self._release()
+        return lines
+
+    def close(self):
+        """Stops git. Safe to call from the Tk thread while a page is being read."""
+        with self._lock:
+            self._closed = True
+            if self._process is not None and self._process.poll() is None:
+                self._process.terminate()
+            if not self._reading:
+                # Otherwise the reader sees EOF and releases the pipe itself
+                self._release()
+
+    def _release(self):
+        if self._process is not None:
+            self._process.stdout.close()
+            self._process.wait()
+            # One span for the whole stream, from start until it was read to the end or closed
+            perf_recorder.add(command_name(self.args) + " (stream)", "git", self._started,
+                              time.perf_counter() - self._started, size=self._size,
+                              returncode=self._process.returncode)
+            self._process = None
+
+
+# One history record per line; fields are separated by \x1f so subjects can hold anything
+HISTORY_FORMAT = "%H%x1f%P%x1f%an%x1f%at%x1f%s"
+HISTORY_CACHE_VERSION = 2
+
+Commit = namedtuple("Commit", "hash parents author timestamp subject")
+
+
+def parse_commit_record(line):
+    """Parses one HISTORY_FORMAT line into a Commit."""
+    return Commit(*line.split("\x1f", 4))
+
+
+def parse_show_ref(output):
+    """Returns (tips, decorations) from `git show-ref --head --dereference`.
+
+    `tips` is the frozenset of every ref's object id and is what the history
+    cache is keyed on; `decorations` maps commit ids to display names.
+    """
+    tips = set()
+    decorations = {}
+    for line in output.splitlines():
+        oid, _, ref = line.partition(" ")
+        if ref.endswith("^{}"):
+            # Peeled annotated tag: decorate the commit it points at
+            ref = ref[:-3]
+        else:
+            tips.add(oid)
+        if ref.startswith("refs/heads/"):
+            name = ref[len("refs/heads/"):]
+        elif ref.startswith("refs/remotes/"):
+            name = ref[len("refs/remotes/"):]
+        elif ref.startswith("refs/tags/"):
+            name = "tag: " + ref[len("refs/tags/"):]
+        elif ref == "HEAD":
+            name = "HEAD"
+        else:
+            continue
+        names = decorations.setdefault(oid, [])
+        if name not in names:
+            names.append(name)
+    return frozenset(tips), decorations
+
+
+def user_cache_dir():
+    """Returns Git Bridge's per-user cache directory (not created here)."""
+    base = os.environ.get("LOCALAPPDATA") or os.environ.get("XDG_CACHE_HOME") \
+        or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "GitBridge")
+
+
+def history_cache_path(repo_path):
+    """Returns where the history cache for a repository lives in the user cache dir."""
+    key = hashlib.sha1(os.path.abspath(repo_path).encode("utf-8")).hexdigest()
+    return os.path.join(user_cache_dir(), "history", key + ".log")
+
+
+def load_history_cache(path):
+    """Returns (tips, commits, truncated) from a history cache file, or None if there is no usable cache.
+
+    `truncated` is set when the cached commits stop short of the full history.
+    """
+    try:
+        with open(path, "r", encoding="utf-8", newline="\n") as f:
+            header = f.readline().split()
+            if header[:2] != ["gitbridge-history", str(HISTORY_CACHE_VERSION)] \
+                    or header[2:3] not in (["complete"], ["truncated"]):
+                return None
+            commits = [parse_commit_record(line.rstrip("\n")) for line in f]
+    except (OSError, TypeError, ValueError):
+        return None
+    return frozenset(header[3:]), commits, header[2] == "truncated"
+
+
+def save_history_cache(path, tips, commits, truncated=False):
+    """Writes the cache atomically so a crash never leaves a half-written file behind."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    state = "truncated" if truncated else "complete"
+    with open(tmp_path, "w", encoding="utf-8", newline="\n") as f:
+        f.write(f"gitbridge-history {HISTORY_CACHE_VERSION} {state} {' '.join(sorted(tips))}\n")
+        for commit in commits:
+            f.write("\x1f".join(commit) + "\n")
+    os.replace(tmp_path, path)
+
+
+def run_git_with_input(args, cwd, input_lines):
+    """Runs a read-only git command that takes revisions on stdin. Returns stdout or None."""
+    process = popen_git(args, cwd, write=False, stdin=subprocess.PIPE, encoding="utf-8", errors="replace")
+    stdout, _ = process.communicate("".join(line + "\n" for line in input_lines))
+    return stdout if process.returncode == 0 else None
+
+
+def read_new_commits(cwd, tips, old_tips):
+    """Returns the commits reachable from `tips` but not from `old_tips`, newest first.
+
+    Returns None when the cached history can't simply be extended, i.e. when an
+    old tip is no longer reachable because a branch was deleted or force-pushed.
+    """
+    dropped = old_tips - tips
+    if dropped:
+        orphaned = run_git_with_input(["rev-list", "-n", "1", "--stdin"], cwd,
+                                      list(dropped) + ["^" + tip for tip in tips])
+        if orphaned is None or orphaned.strip():
+            return None
+    output = run_git_with_input(["log", "--topo-order", "--format=" + HISTORY_FORMAT, "--stdin"], cwd,
+                                list(tips) + ["^" + tip for tip in old_tips])
+    if output is None:
+        return None
+    return [parse_commit_record(line) for line in output.splitlines()]
+
+
+WORD = re.compile(r"\w+")
+# Search terms of the form `key:value`; anything else is matched against commit subjects
+QUERY_KEYS = frozenset({"author", "hash", "after", "before", "path"})
+# Commits are bucketed by this many leading hash characters for hash prefix lookups
+INDEX_HASH_CHARS = 4
+# A bare hexadecimal term at least this long (with a digit in it) is taken as a hash prefix
+QUERY_HASH_MIN = 7
+
+CommitQuery = namedtuple("CommitQuery", "words authors hashes after before paths")
+
+
+def parse_query_date(value, end=False):
+    """Returns the timestamp of local midnight starting (or, with `end`, ending) a YYYY-MM-DD day."""
+    try:
+        day = time.mktime(time.strptime(value, "%Y-%m-%d"))
+    except ValueError:
+        raise ValueError(f"Dates look like 2024-01-31, not {value!r}")
+    return day + 86400 if end else day
+
+
+def parse_commit_query(text):
+    """Parses a history search, e.g. `fix crash author:ann after:2024-01-01 path:src/app.py`.
+
+    Plain words must all prefix-match words of the subject. Raises ValueError for a bad date.
+    """
+    try:
+        terms = shlex.split(text)
+    except ValueError:
+        terms = text.split()  # An unbalanced quote: just split on spaces
+    words, authors, hashes, paths = [], [], [], []
+    after = before = None
+    for term in terms:
+        key, sep, value = term.partition(":")
+        key = key.lower()
+        if sep and value and key in QUERY_KEYS:
+            if key == "author":
+                authors.extend(WORD.findall(value.lower()))
+            elif key == "hash":
+                hashes.append(value.lower())
+            elif key == "after":
+                after = parse_query_date(value)
+            elif key == "before":
+                before = parse_query_date(value, end=True)
+            else:
+                paths.append(value)
+        elif len(term) >= QUERY_HASH_MIN and all(c in "0123456789abcdefABCDEF" for c in term) \
+                and any(c.isdigit() for c in term):
+            hashes.append(term.lower())
+        else:
+            words.extend(WORD.findall(term.lower()))
+    return CommitQuery(words, authors, hashes, after, before, paths)
+
+
+def has_word(words, prefix):
+    """Matches a search word the way CommitIndex does: by prefix, except single letters."""
+    if len(prefix) < 2:
+        return prefix in words
+    return any(word.startswith(prefix) for word in words)
+
+
+def query_matches(query, commit):
+    """Checks one commit against everything in a query except paths (used on git's own results)."""
+    subject = WORD.findall(commit.subject.lower())
+    author = WORD.findall(commit.author.lower())
+    timestamp = int(commit.timestamp)
+    return (all(has_word(subject, word) for word in query.words)
+            and all(has_word(author, word) for word in query.authors)
+            and all(commit.hash.startswith(prefix) for prefix in query.hashes)
+            and (query.after is None or timestamp >= query.after)
+            and (query.before is None or timestamp < query.before))
+
+
+class CommitIndex:
+    """Inverted index of commit subjects and authors, built as history is loaded.
+
+    Commits are numbered in row order: commits added at the end count up and commits
+    added in front count down, so earlier numbers never have to change. Postings
+    are arrays of those numbers; the sorted vocabularies used for prefix lookups
+    are only rebuilt when a search follows new words. Commits cut off the end by
+    truncate() leave their numbers in the postings until those outnumber the live
+    ones, and then the index is rebuilt.
+    """
+
+    def __init__(self):
+        self._commits = {}  # number -> Commit
+        self._first = 0
+        self._next = 0
+        self._postings = {"subject": {}, "author": {}}  # field -> word -> array of commit numbers
+        self._vocabulary = {}  # field -> sorted words; dropped when that field gets a new word
+        self._hashes = {}  # First INDEX_HASH_CHARS of the hash -> array of commit numbers
+        self._hours = {}  # Commit time // 3600 -> array of commit numbers
+        self._hour_keys = None  # Sorted keys of _hours; dropped when a new hour appears
+        self._stale = 0  # Numbers in the postings whose commits were truncated away
+
+    def __len__(self):
+        return len(self._commits)
+
+    def truncate(self, count):
+        """Keeps only the first `count` commits."""
+        end = self._first + count
+        if end >= self._next:
+            return
+        for number in range(end, self._next):
+            del self._commits[number]
+        self._stale += self._next - end
+        self._next = end
+        if self._stale > len(self._commits):
+            commits = [self._commits[n] for n in range(self._first, end)]
+            self.__init__()
+            self.add(commits)
+
+    def add(self, commits, front=False):
+        if front:
+            self._first -= len(commits)
+            numbers = range(self._first, self._first + len(commits))
+        else:
+            numbers = range(self._next, self._next + len(commits))
+            self._next += len(commits)
+        for number, commit in zip(numbers, commits):
+            self._commits[number] = commit
+            self._post("subject", commit.subject, number)
+            self._post("author", commit.author, number)
+            self._hashes.setdefault(commit.hash[:INDEX_HASH_CHARS], array("q")).append(number)
+            hour = int(commit.timestamp) // 3600
+            numbers = self._hours.get(hour)
+            if numbers is None:
+                numbers = self._hours[hour] = array("q")
+                self._hour_keys = None
+            numbers.append(number)
+
+    def _post(self, field, text, number):
+        postings = self._postings[field]
+        for word in set(WORD.findall(text.lower())):
+            numbers = postings.get(word)
+            if numbers is None:
+                numbers = postings[word] = array("q")
+                self._vocabulary.pop(field, None)
+            numbers.append(number)
+
+    def _prefixed(self, field, prefix):
+        """Returns the set of commit numbers with a `field` word that starts with `prefix`."""
+        postings = self._postings[field]
+        if len(prefix) < 2:
+            return set(postings.get(prefix, ()))  # Single letters only match whole words
+        words = self._vocabulary.get(field)
+        if words is None:
+            words = self._vocabulary[field] = sorted(postings)
+        found = set()
+        for i in range(bisect.bisect_left(words, prefix), len(words)):
+            if not words[i].startswith(prefix):
+                break
+            found.update(postings[words[i]])
+        return found
+
+    def _hash_prefixed(self, prefix):
+        commits = self._commits
+        if len(prefix) >= INDEX_HASH_CHARS:
+            numbers = self._hashes.get(prefix[:INDEX_HASH_CHARS], ())
+        else:
+            numbers = itertools.chain.from_iterable(numbers for key, numbers in self._hashes.items()
+                                                    if key.startswith(prefix))
+        return {n for n in numbers if n < self._next and commits[n].hash.startswith(prefix)}
+
+    def _between(self, after, before):
+        """Returns the set of commit numbers with after <= commit time < before."""
+        hours = self._hour_keys
+        if hours is None:
+            hours = self._hour_keys = sorted(self._hours)
+        # Only the hours that have commits are visited, however far apart the bounds are
+        start = 0 if after is None else bisect.bisect_left(hours, int(after) // 3600)
+        end = len(hours) if before is None else bisect.bisect_right(hours, int(before) // 3600)
+        first = None if after is None else int(after) // 3600
+        last = None if before is None else int(before) // 3600
+        after = float("-inf") if after is None else after
+        before = float("inf") if before is None else before
+        commits = self._commits
+        found = set()
+        for hour in itertools.islice(hours, start, end):
+            numbers = self._hours[hour]
+            if hour in (first, last):
+                # Only the hours at either end can hold commits outside the range
+                found.update(n for n in numbers if n < self._next and after <= int(commits[n].timestamp) < before)
+            else:
+                found.update(numbers)
+        return found
+
+    def search(self, query):
+        """Returns the commits matching `query` (paths are ignored) in history order."""
+        sets = [self._prefixed("subject", word) for word in query.words]
+        sets += [self._prefixed("author", word) for word in query.authors]
+        sets += [self._hash_prefixed(prefix) for prefix in query.hashes]
+        if query.after is not None or query.before is not None:
+            sets.append(self._between(query.after, query.before))
+        if sets:
+            sets.sort(key=len)
+            numbers = sets[0].intersection(*sets[1:])
+        else:
+            numbers = self._commits.keys()
+        commits = self._commits
+        return [commits[n] for n in sorted(numbers) if n < self._next]
+
+
+class CommitGraph:
+    """Commits in topological order with graph lanes computed lazily, row by row.
+
+    `index` is a CommitIndex over the same commits, kept in step as rows are added and dropped.
+    """
+
+    def __init__(self, commits=()):
+        self.commits = list(commits)
+        self.index = CommitIndex()
+        self.index.add(self.commits)
+        self._rows = []
+        self._lanes = []  # Commit each open lane is waiting for, after the last computed row
+
+    def __len__(self):
+        return len(self.commits)
+
+    def extend(self, commits):
+        self.commits.extend(commits)
+        self.index.add(commits)
+
+    def prepend(self, commits, limit):
+        """Adds newer commits in front, keeping at most `limit` rows; lanes are recomputed.
+
+        Commits pushed out at the bottom leave the index too, so it stays as small as
+        the rows. Returns how many rows were pushed out.
+        """
+        self.commits[:0] = commits
+        dropped = max(0, len(self.commits) - limit)
+        del self.commits[limit:]
+        self.index.add(commits, front=True)
+        self.index.truncate(limit)
+        self._rows = []
+        self._lanes = []
+        return dropped
+
+    def graph(self, row):
+        """Returns the lane drawing (e.g. "| * |") for a row."""
+        while len(self._rows) <= row:
+            self._rows.append(self._next_row(self.commits[len(self._rows)]))
+        return self._rows[row]
+
+    def _next_row(self, commit):
+        lanes = self._lanes
+        if commit.hash in lanes:
+            col = lanes.index(commit.hash)
+        elif None in lanes:
+            col = lanes.index(None)
+        else:
+            col = len(lanes)
+            lanes.append(None)
+
+        glyphs = []
+        for i, lane in enumerate(lanes):
+            if i == col:
+                glyphs.append("*")
+            elif lane == commit.hash:
+                # Another child's lane ends here
+                glyphs.append("/" if i > col else "\\")
+                lanes[i] = None
+            else:
+                glyphs.append(" " if lane is None else "|")
+
+        parents = commit.parents.split()
+        lanes[col] = parents[0] if parents else None
+        for parent in parents[1:]:
+            if parent in lanes:
+                continue
+            if None in lanes:
+                i = lanes.index(None)
+            else:
+                i = len(lanes)
+                lanes.append(None)
+                glyphs.append(" ")
+            lanes[i] = parent
+            glyphs[i] = "\\" if i > col else "/"
+        while lanes and lanes[-1] is None:
+            lanes.pop()
+        return " ".join(glyphs)
+
+
+# Most commits a history search shows when it has to ask `git log` (path searches)
+SEARCH_MAX_RESULTS = 10_000
+# Shortest hash prefix git can look up by itself (`git rev-parse --disambiguate`)
+SEARCH_HASH_LOOKUP_MIN = 4
+
+
+def commit_search_args(query, complete=True):
+    """Returns the `git log` arguments that answer `query` when the index can't.
+
+    With `complete` (the loaded history is all of it) only the paths are left to git;
+    otherwise subjects, authors and dates are filtered by git too. Either way the
+    results still go through query_matches.
+    """
+    args = ["log", "--all", "--topo-order", "--format=" + HISTORY_FORMAT]
+    if not complete:
+        args += ["-i", "--all-match"] + [f"--grep={word}" for word in query.words]
+        args += [f"--author={word}" for word in query.authors]
+        if query.after is not None:
+            args.append(f"--since={int(query.after)}")
+        if query.before is not None:
+            args.append(f"--until={int(query.before)}")
+    return args + ["--"] + [":(literal)" + path for path in query.paths]
+
+
+def read_commits_by_prefix(cwd, prefix, paths=()):
+    """Returns the commits whose hash starts with `prefix`, optionally only those touching `paths`.
+
+    Asks git for the objects with that prefix instead of scanning the log, so any
+    commit is found however old it is. Returns None if git fails.
+    """
+    objects = run_git_with_input(["rev-parse", "--disambiguate=" + prefix], cwd, [])
+    if objects is None:
+        return None
+    if not objects.strip():
+        return []
+    types = run_git_with_input(["cat-file", "--batch-check=%(objecttype) %(objectname)"], cwd, objects.split())
+    if types is None:
+        return None
+    commits = [line.split()[1] for line in types.splitlines() if line.startswith("commit ")]
+    if not commits:
+        return []
+    output = run_git_with_input(["log", "--no-walk", "--stdin", "--format=" + HISTORY_FORMAT, "--"]
+                                + [":(literal)" + path for path in paths], cwd, commits)
+    return None if output is None else [parse_commit_record(line) for line in output.splitlines()]
+
+
+# Commit History reads this many lines of `git log` at a time
+HISTORY_PAGE_SIZE = 500
+# Loaded history rows (and the search index over them) are capped so memory stays bounded
+# however big the repository is
+HISTORY_MAX_ROWS = 100_000
+
+# A file's diff is only shown straight away if numstat says it is smaller than this
+DIFF_MAX_LINES = 3000
+# Lines of diff read from git per background step
+DIFF_CHUNK_LINES = 500
+# File lists and file diffs kept from earlier in the session
+DIFF_CACHE_SIZE = 128
+# Treeview rows added per Tk event loop turn when listing a commit's files
+DIFF_FILE_BATCH = 500
+# Flags shared by the file list and the per-file diff, so both describe the same change
+DIFF_TREE_ARGS = ["diff-tree", "-r", "--root", "-m", "--first-parent", "--no-commit-id", "-M"]
+
+FileChange = namedtuple("FileChange", "status path old_path added deleted")
+
+
+def parse_diff_tree(output):
+    """Parses `git diff-tree --raw --numstat -z` output into FileChanges.
+
+    `added`/`deleted` are None for binary files.
+    """
+    tokens = output.split("\0")
+    changes = OrderedDict()
+    counts = {}
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if not token:
+            i += 1
+        elif token.startswith(":"):
+            # ":<old mode> <new mode> <old sha> <new sha> <status>", then one path or two for renames/copies
+            status = token.split()[-1]
+            if status[0] in "RC":
+                old_path, path = tokens[i + 1], tokens[i + 2]
+                i += 3
+            else:
+                old_path = path = tokens[i + 1]
+                i += 2
+            changes[path] = (status[0], old_path)
+        else:
+            # "<added>\t<deleted>\t<path>", or an empty path followed by the two rename paths
+            added, deleted, path = token.split("\t", 2)
+            if path:
+                i += 1
+            else:
+                path = tokens[i + 2]
+                i += 3
+            counts[path] = (None, None) if added == "-" else (int(added), int(deleted))
+    return [FileChange(status, path, old_path, *counts.get(path, (0, 0)))
+            for path, (status, old_path) in changes.items()]
+
+
+class LRUCache:
+    """A small least-recently-used cache."""
+
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self._items:
+            return default
+        self._items.move_to_end(key)
+        return self._items[key]
+
+    def put(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
+
+
+def resolve_git_dir(worktree):
+    """Returns the git directory for a worktree, following a `gitdir:` file; None if not a repository."""
+    dot_git = os.path.join(worktree, ".git")
+    if os.path.isdir(dot_git):
+        return dot_git
+    try:
+        with open(dot_git, "r", encoding="utf-8") as f:
+            line = f.readline().strip()
+    except OSError:
+        return None
+    if not line.startswith("gitdir:"):
+        return None
+    git_dir = line[len("gitdir:"):].strip()
+    git_dir = os.path.normpath(os.path.join(worktree, git_dir))
+    return git_dir if os.path.isdir(git_dir) else None
+
+
+CONFIG_SECTION = re.compile(r'\[\s*([A-Za-z0-9.-]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\]$')
+CONFIG_ESCAPES = {"n": "\n", "t": "\t", "b": "\b", "\\": "\\", '"': '"'}
+
+
+def parse_config_value(raw):
+    """Unquotes a config value and strips its trailing comment."""
+    value = []
+    quoted = False
+    pending_space = ""
+    chars = iter(raw)
+    for char in chars:
+        if char == "\\":
+            escaped = next(chars, "")
+            if escaped not in CONFIG_ESCAPES:
+                raise ValueError(f"unsupported escape in config value: {raw!r}")
+            value.append(pending_space + CONFIG_ESCAPES[escaped])
+            pending_space = ""
+        elif char == '"':
+            quoted = not quoted
+            value.append(pending_space)
+            pending_space = ""
+        elif char in "#;" and not quoted:
+            break
+        elif char.isspace() and not quoted:
+            pending_space += char
+        else:
+            value.append(pending_space + char)
+            pending_space = ""
+    return "".join(value)
+
+
+def parse_git_config(text):
+    """Parses a git config file into {(section, subsection): {key: [values]}}.
+
+    Section and key names are lowercased as git does. Raises ValueError for anything
+    this small parser doesn't support (includes, line continuations) so callers can
+    ask git instead.
+    """
+    config = {}
+    section = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line[0] in "#;":
+            continue
+        if line.startswith("["):
+            match = CONFIG_SECTION.match(line)
+            if not match:
+                raise ValueError(f"unsupported config section: {line!r}")
+            name, subsection = match.group(1).lower(), match.group(2)
+            if subsection is not None:
+                subsection = re.sub(r'\\(.)', r'\1', subsection)
+            elif "." in name:
+                # Deprecated [section.subsection] syntax
+                name, subsection = name.split(".", 1)
+            if name in ("include", "includeif"):
+                raise ValueError("config includes are not supported")
+            section = config.setdefault((name, subsection), {})
+            continue
+        if section is None or line.endswith("\\"):
+            raise ValueError(f"unsupported config line: {line!r}")
+        key, has_value, raw = line.partition("=")
+        value = parse_config_value(raw.strip()) if has_value else "true"
+        section.setdefault(key.strip().lower(), []).append(value)
+    return config
+
+
+class GitRepoReader:
+    """Answers simple questions about a repository by reading .git directly.
+
+    Covers HEAD, loose and packed refs and the config file, including linked
+    worktrees and `.git` files pointing elsewhere. Every file is parsed once and
+    only re-read when its mtime or size changes. Methods return None when the
+    repository uses something this reader doesn't handle, so callers can fall back
+    to running git.
+    """
+
+    def __init__(self, worktree):
+        self.worktree = worktree
+        self._files = {}  # path -> ((mtime, size), parsed value)
+        self.git_dir = resolve_git_dir(worktree)
+        self.common_dir = self.git_dir
+        if self.git_dir is not None:
+            commondir = self._read(os.path.join(self.git_dir, "commondir"), str.strip)
+            if commondir:
+                # A linked worktree: refs, packed-refs and config live in the main repository
+                self.common_dir = os.path.normpath(os.path.join(self.git_dir, commondir))
+
+    def _read(self, path, parse):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = self._files.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        try:
+            with open(path, "r", encoding="utf-8", errors="replace") as f:
+                value = parse(f.read())
+        except (OSError, ValueError):
+            value = None
+        self._files[path] = (key, value)
+        return value
+
+    @property
+    def supported(self):
+        """False for repositories whose refs aren't stored as files (reftable)."""
+        return self.git_dir is not None and not os.path.isdir(os.path.join(self.common_dir, "reftable"))
+
+    def head(self):
+        """Returns ("ref", "refs/heads/<name>") or ("detached", <oid>), or None."""
+        if not self.supported:
+            return None
+        content = self._read(os.path.join(self.git_dir, "HEAD"), str.strip)
+        if not content:
+            return None
+        if content.startswith("ref:"):
+            return "ref", content[4:].strip()
+        return "detached", content
+
+    def current_branch(self):
+        """Returns the checked-out branch name, "HEAD" when detached, or None."""
+        head = self.head()
+        if head is None:
+            return None
+        kind, value = head
+        if kind == "detached":
+            return "HEAD"
+        return value[len("refs/heads/"):] if value.startswith("refs/heads/") else value
+
+    def head_oid(self):
+        head = self.head()
+        if head is None:
+            return None
+        kind, value = head
+        return value if kind == "detached" else self.refs().get(value)
+
+    def packed_refs(self):
+        def parse(text):
+            refs = {}
+            for line in text.splitlines():
+                if line and line[0] not in "#^":
+                    oid, _, ref = line.partition(" ")
+                    refs[ref.strip()] = oid
+            return refs
+
+        return self._read(os.path.join(self.common_dir, "packed-refs"), parse) or {}
+
+    def refs(self, prefix="refs/"):
+        """Returns {refname: oid} for every ref under `prefix`, loose refs overriding packed ones."""
+        if not self.supported:
+            return None
+        refs = {ref: oid for ref, oid in self.packed_refs().items() if ref.startswith(prefix)}
+        pending = [prefix.rstrip("/")]
+        while pending:
+            relative = pending.pop()
+            try:
+                with os.scandir(os.path.join(self.common_dir, relative)) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            for entry in entries:
+                ref = f"{relative}/{entry.name}"
+                if entry.is_dir():
+                    pending.append(ref)
+                elif not entry.name.endswith(".lock"):
+                    oid = self._read(entry.path, str.strip)
+                    if oid and not oid.startswith("ref:"):
+                        refs[ref] = oid
+        return refs
+
+    def branches(self):
+        """Returns local branch names, sorted."""
+        refs = self.refs("refs/heads/")
+        if refs is None:
+            return None
+        return sorted(ref[len("refs/heads/"):] for ref in refs)
+
+    def ref_snapshot(self):
+        """Returns a hashable snapshot of HEAD and every ref; equal snapshots mean nothing moved."""
+        refs = self.refs()
+        if refs is None:
+            return None
+        return self.head(), frozenset(refs.items())
+
+    def config(self):
+        if self.git_dir is None:
+            return None
+        return self._read(os.path.join(self.common_dir, "config"), parse_git_config)
+
+    def remotes(self):
+        """Returns {name: (fetch url, push url)}, or None if the config couldn't be read."""
+        config = self.config()
+        if config is None or any(section == "url" for section, _ in config):
+            return None  # url.<base>.insteadOf rewriting is left to git
+        remotes = {}
+        for (section, name), values in config.items():
+            if section == "remote" and name is not None and "url" in values:
+                url = values["url"][0]
+                remotes[name] = (url, values.get("pushurl", [url])[0])
+        return remotes
+
+
+# Stage or unstage any number of paths with one process: NUL-separated pathspecs come in on stdin
+STAGE_ARGS = ["add", "--pathspec-from-file=-", "--pathspec-file-nul"]
+UNSTAGE_ARGS = ["reset", "-q", "--pathspec-from-file=-", "--pathspec-file-nul"]
+
+
+def run_git_with_pathspecs(args, cwd, paths):
+    """Runs a git command that reads pathspecs from stdin (STAGE_ARGS, UNSTAGE_ARGS). Returns stdout.
+
+    Paths are taken literally and written with popen_git's codec, the one status
+    output is read with, so a path goes back to git as exactly the bytes git gave.
+    Raises RuntimeError with git's message if it fails.
+    """
+    process = popen_git(args, cwd, stdin=subprocess.PIPE, extra_env={"GIT_LITERAL_PATHSPECS": "1"})
+    stdout, stderr = process.communicate("".join(path + "\0" for path in paths))
+    if process.returncode != 0:
+        raise RuntimeError(stderr.strip() or f"git {args[0]} exited with {process.returncode}")
+    return stdout
+
+
+class ChangeTree:
+    """Changed paths from a RepoStatus grouped by directory.
+
+    Grouping is one pass over the paths (run it on a worker thread for big change
+    sets); a directory's children are only sorted when rows(directory) first asks
+    for them. Untracked directories git reports as "dir/" stay single entries.
+    """
+
+    def __init__(self, entries):
+        self.entries = entries  # path -> (kind, xy), as in RepoStatus.entries
+        self.counts = {}  # directory -> changed paths anywhere below it
+        self._children = {}  # directory ("" for the top) -> [set of subdirectories, list of paths]
+        self._sorted = {}
+        children = self._children
+        counts = self.counts
+        for path in entries:
+            parent = path.rstrip("/").rpartition("/")[0]
+            node = children.get(parent)
+            if node is None:
+                node = children[parent] = [set(), []]
+            node[1].append(path)
+            while parent:
+                counts[parent] = counts.get(parent, 0) + 1
+                grandparent = parent.rpartition("/")[0]
+                node = children.get(grandparent)
+                if node is None:
+                    node = children[grandparent] = [set(), []]
+                node[0].add(parent)
+                parent = grandparent
+
+    def __len__(self):
+        return len(self.entries)
+
+    def is_dir(self, path):
+        return path in self.counts
+
+    def rows(self, directory=""):
+        """Returns the subdirectories and then the changed paths directly in `directory`, sorted."""
+        rows = self._sorted.get(directory)
+        if rows is None:
+            dirs, paths = self._children.get(directory, ((), ()))
+            rows = self._sorted[directory] = sorted(dirs) + sorted(paths)
+        return rows
+
+
+class RepoStatus:
+    """Branch, upstream and changed paths parsed from `git status --porcelain=v2 --branch -z`.
+
+    `entries` maps each changed path to (kind, xy): kind is "1" (changed), "2"
+    (renamed/copied), "u" (unmerged) or "?" (untracked), and xy is git's two-letter
+    index/worktree status ('.' = unchanged). `renames` maps the path of each renamed or
+    copied entry to the path it came from.
+    """
+
+    def __init__(self):
+        self.oid = None
+        self.branch = None
+        self.upstream = None
+        self.ahead = 0
+        self.behind = 0
+        self.entries = {}
+        self.renames = {}
+
+    @property
+    def staged(self):
+        return sum(1 for kind, xy in self.entries.values() if kind in "12" and xy[0] != ".")
+
+    @property
+    def unstaged(self):
+        return sum(1 for kind, xy in self.entries.values() if kind in "12" and xy[1] != ".")
+
+    @property
+    def untracked(self):
+        return sum(1 for kind, _ in self.entries.values() if kind == "?")
+
+    @property
+    def conflicts(self):
+        return sum(1 for kind, _ in self.entries.values() if kind == "u")
+
+    @property
+    def has_changes(self):
+        return bool(self.entries)
+
+    def refresh_pathspecs(self, paths):
+        """Returns the pathspecs for a status limited to `paths`, relative to the worktree.
+
+        Git lists an untracked directory as one "dir/" entry, and asking about a single
+        file in it would report just that file, so such paths ask about the whole directory.
+        """
+        collapsed = tuple(key for key, (kind, _) in self.entries.items() if kind == "?" and key.endswith("/"))
+        specs = set()
+        for path in paths:
+            directory = next((key for key in collapsed if path.startswith(key)), None) if collapsed else None
+            specs.add(path if directory is None else directory.rstrip("/"))
+        return sorted(specs)
+
+    def merge(self, partial, pathspecs, worktree):
+        """Folds in a status that was limited to `pathspecs` (paths relative to `worktree`).
+
+        Entries at or below those paths are replaced by the partial result; the branch
+        header always comes from the partial result since it covers the whole repository.
+        """
+        self.oid, self.branch, self.upstream = partial.oid, partial.branch, partial.upstream
+        self.ahead, self.behind = partial.ahead, partial.behind
+        prefixes = []
+        for path in pathspecs:
+            self.entries.pop(path, None)
+            if not os.path.isfile(os.path.join(worktree, path)):
+                prefixes.append(path + "/")  # A directory, or something that no longer exists
+        if prefixes:
+            prefixes = tuple(prefixes)
+            for key in [key for key in self.entries if key.startswith(prefixes)]:
+                del self.entries[key]
+        # Untracked directories are listed as "dir/"; drop them if something inside changed
+        for key in [key for key in self.entries if key.endswith("/") and any(p.startswith(key) for p in pathspecs)]:
+            del self.entries[key]
+        self.entries.update(partial.entries)
+        self.renames = {path: source for path, source in self.renames.items() if self.entries.get(path, ("",))[0] == "2"}
+        self.renames.update(partial.renames)
+
+    def rename_sources(self, paths):
+        """Returns the original paths of the renames at or below `paths`, e.g. to unstage them too."""
+        prefixes = tuple(path.rstrip("/") + "/" for path in paths)
+        return sorted(source for path, source in self.renames.items() if path in paths or path.startswith(prefixes))
+
+
+def parse_status_v2(output):
+    """Parses `git status --porcelain=v2 --branch -z` output into a RepoStatus."""
+    status = RepoStatus()
+    records = iter(output.split("\0"))
+    for record in records:
+        if record.startswith("# "):
+            key, _, value = record[2:].partition(" ")
+            if key == "branch.oid":
+                status.oid = None if value == "(initial)" else value
+            elif key == "branch.head":
+                status.branch = value
+            elif key == "branch.upstream":
+                status.upstream = value
+            elif key == "branch.ab":
+                ahead, behind = value.split()
+                status.ahead = int(ahead)
+                status.behind = -int(behind)
+        elif record.startswith("1 "):
+            status.entries[record.split(" ", 8)[8]] = ("1", record[2:4])
+        elif record.startswith("2 "):
+            path = record.split(" ", 9)[9]
+            status.entries[path] = ("2", record[2:4])
+            # The original path of the rename follows as its own record
+            status.renames[path] = next(records, "")
+        elif record.startswith("u "):
+            status.entries[record.split(" ", 10)[10]] = ("u", record[2:4])
+        elif record.startswith("? "):
+            status.entries[record[2:]] = ("?", "??")
+    return status
+
+
+_fsmonitor_supported = None
+
+
+def fsmonitor_supported():
+    """Returns True if this git has the built-in fsmonitor daemon (Windows and macOS builds)."""
+    global _fsmonitor_supported
+    if _fsmonitor_supported is None:
+        try:
+            result = subprocess.run(["git", "version", "--build-options"], capture_output=True, text=True,
+                                    creationflags=CREATE_NO_WINDOW)
+            _fsmonitor_supported = "fsmonitor--daemon" in result.stdout
+        except OSError:
+            _fsmonitor_supported = False
+    return _fsmonitor_supported
+
+
+def status_args(pathspecs=None, fsmonitor=False):
+    """Returns the `git status` arguments parse_status_v2 expects, limited to `pathspecs` if given.
+
+    `fsmonitor` turns on git's file system monitor daemon where this git has one. Only
+    pass it for a repository the user works in whose config doesn't set core.fsmonitor:
+    the daemon keeps running after the command.
+    """
+    args = ["status", "--porcelain=v2", "--branch", "-z"]
+    if fsmonitor and fsmonitor_supported():
+        # Let git's own file system monitor answer what changed
+        args = ["-c", "core.fsmonitor=true"] + args
+    if pathspecs is not None:
+        args += ["--"] + [":(literal)" + spec for spec in pathspecs]
+    return args
+
+
+# Files directly in .git whose changes mean branch, index or refs moved
+WATCH_METADATA_FILES = frozenset({"HEAD", "index", "packed-refs", "FETCH_HEAD", "ORIG_HEAD", "MERGE_HEAD", "config"})
+# Beyond this many worktree directories inotify watches are not worth it; poll instead
+WATCH_MAX_DIRS = 20000
+# Beyond this many changed paths one full status is cheaper than a pathspec-limited one
+WATCH_MAX_DIRTY_PATHS = 200
+# How often GitApp collects changes from the watcher
+WATCH_CHECK_MS = 250
+# Polling fallback: .git metadata every second, the worktree no more often than this
+WATCH_POLL_INTERVAL = 1.0
+WATCH_WORKTREE_POLL_INTERVAL = 3.0
+
+# inotify(7) constants
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class RepoWatcher:
+    """Watches a worktree and its .git metadata from a background thread.
+
+    Worktree changes are collected as paths relative to the worktree; changes to
+    HEAD, the index or refs just flag that a full refresh is needed. Uses inotify on
+    Linux and falls back to polling elsewhere or when the tree is too big to watch.
+    The Tk thread collects what changed with take().
+    """
+
+    def __init__(self, worktree, git_dir=None, common_dir=None):
+        self.worktree = worktree
+        self.git_dir = git_dir or os.path.join(worktree, ".git")
+        self.common_dir = common_dir or self.git_dir
+        self.backend = None
+        self._lock = threading.Lock()
+        self._dirty = set()
+        self._full = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="repo-watcher", daemon=True)
+        self._thread.start()
+
+    def take(self):
+        """Returns (paths, full) changed since the last call; `full` means refresh everything."""
+        with self._lock:
+            paths, full = self._dirty, self._full
+            self._dirty, self._full = set(), False
+        if len(paths) > WATCH_MAX_DIRTY_PATHS or "" in paths:
+            full = True
+        return (set() if full else paths), full
+
+    def stop(self):
+        self._stop.set()
+
+    def _mark(self, path):
+        with self._lock:
+            self._dirty.add(path)
+
+    def _mark_full(self):
+        with self._lock:
+            self._full = True
+
+    def _run(self):
+        if sys.platform.startswith("linux"):
+            try:
+                self.backend = "inotify"
+                self._run_inotify()
+                return
+            except OSError:
+                pass
+        self.backend = "polling"
+        self._run_polling()
+
+    # -- inotify ------------------------------------------------------------
+
+    def _run_inotify(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        watches = {}  # wd -> ("git", relative dir inside .git) or ("tree", relative dir in worktree)
+
+        def add_watch(path, key):
+            wd = libc.inotify_add_watch(fd, os.fsencode(path), IN_WATCH_MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+            watches[wd] = key
+
+        def add_tree(relative):
+            for root, dirs, _ in os.walk(os.path.join(self.worktree, relative)):
+                if ".git" in dirs:
+                    dirs.remove(".git")
+                relative_root = os.path.relpath(root, self.worktree).replace(os.sep, "/")
+                add_watch(root, ("tree", "" if relative_root == "." else relative_root))
+                if len(watches) > WATCH_MAX_DIRS:
+                    raise OSError("too many directories to watch")
+
+        def add_refs(relative):
+            for root, _, _ in os.walk(os.path.join(self.common_dir, relative)):
+                add_watch(root, ("git", os.path.relpath(root, self.common_dir).replace(os.sep, "/")))
+
+        try:
+            add_watch(self.git_dir, ("git", ""))
+            if self.common_dir != self.git_dir:
+                add_watch(self.common_dir, ("git", ""))
+            add_refs("refs")
+            add_tree("")
+            while not self._stop.is_set():
+                if not select.select([fd], [], [], 0.5)[0]:
+                    continue
+                try:
+                    data = os.read(fd, 65536)
+                except BlockingIOError:
+                    continue
+                offset = 0
+                while offset < len(data):
+                    wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                    name = data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length]
+                    name = os.fsdecode(name.rstrip(b"\0"))
+                    offset += INOTIFY_EVENT.size + length
+                    if mask & IN_Q_OVERFLOW:
+                        self._mark_full()
+                        continue
+                    if mask & IN_IGNORED:
+                        watches.pop(wd, None)
+                        continue
+                    kind, relative = watches.get(wd, (None, None))
+                    path = f"{relative}/{name}" if relative else name
+                    created_dir = mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO)
+                    if kind == "git":
+                        if name.endswith(".lock"):
+                            continue
+                        if relative or name in WATCH_METADATA_FILES:
+                            self._mark_full()
+                        if created_dir and path.startswith("refs/"):
+                            add_refs(path)
+                    elif kind == "tree":
+                        self._mark(path)
+                        if created_dir:
+                            add_tree(path)
+        finally:
+            os.close(fd)
+
+    # -- polling ------------------------------------------------------------
+
+    def _run_polling(self):
+        metadata = self._metadata_snapshot()
+        tree = self._tree_snapshot()
+        next_tree_scan = time.monotonic() + WATCH_WORKTREE_POLL_INTERVAL
+        while not self._stop.wait(WATCH_POLL_INTERVAL):
+            current = self._metadata_snapshot()
+            if current != metadata:
+                metadata = current
+                self._mark_full()
+            if time.monotonic() >= next_tree_scan:
+                started = time.monotonic()
+                current = self._tree_snapshot()
+                for relative, signature in current.items():
+                    if tree.get(relative) != signature:
+                        self._mark(relative)
+                for relative in tree.keys() - current.keys():
+                    self._mark(relative)
+                tree = current
+                # Back off on trees that take long to scan
+                elapsed = time.monotonic() - started
+                next_tree_scan = time.monotonic() + max(WATCH_WORKTREE_POLL_INTERVAL, 5 * elapsed)
+
+    def _metadata_snapshot(self):
+        snapshot = {}
+        for directory in {self.git_dir, self.common_dir}:
+            for name in WATCH_METADATA_FILES:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                    snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+                except OSError:
+                    pass
+        for root, _, files in os.walk(os.path.join(self.common_dir, "refs")):
+            for name in files:
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                    snapshot[os.path.join(root, name)] = (stat.st_mtime_ns, stat.st_size)
+                except OSError:
+                    pass
+        return snapshot
+
+    def _tree_snapshot(self):
+        """Maps each worktree directory to a signature of its direct entries."""
+        snapshot = {}
+        pending = [""]
+        while pending:
+            relative = pending.pop()
+            entries = []
+            try:
+                with os.scandir(os.path.join(self.worktree, relative)) as it:
+                    for entry in it:
+                        if entry.name == ".git":
+                            continue
+                        child = f"{relative}/{entry.name}" if relative else entry.name
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(child)
+                            entries.append((entry.name, None))
+                        else:
+                            stat = entry.stat(follow_symlinks=False)
+                            entries.append((entry.name, stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                continue
+            snapshot[relative] = hash(tuple(sorted(entries)))
+        return snapshot
+
+
+# Workspace mode: how many repositories are scanned at once, how deep to look for them,
+# and how long an unchanged repository's status is reused before asking git again
+WORKSPACE_WORKERS = min(16, (os.cpu_count() or 2) * 2)
+WORKSPACE_MAX_DEPTH = 4
+WORKSPACE_STATUS_TTL = 60.0
+WORKSPACE_SKIP_DIRS = frozenset({"node_modules", "__pycache__", "venv", "build", "dist"})
+# Worktrees with more files and directories than this are always asked about, rather than walked
+WORKSPACE_WALK_MAX_ENTRIES = 20_000
+
+WorkspaceEntry = namedtuple("WorkspaceEntry", "path status error elapsed_ms cached")
+
+
+def discover_repositories(root, max_depth=WORKSPACE_MAX_DEPTH):
+    """Returns the repositories under `root`, without descending into repositories."""
+    repos = []
+    pending = [(root, 0)]
+    while pending:
+        path, depth = pending.pop()
+        if os.path.exists(os.path.join(path, ".git")):
+            repos.append(path)
+            continue
+        if depth >= max_depth:
+            continue
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False) and not entry.name.startswith(".") \
+                            and entry.name not in WORKSPACE_SKIP_DIRS:
+                        pending.append((entry.path, depth + 1))
+        except OSError:
+            continue
+    return sorted(repos)
+
+
+def worktree_signature(path, max_entries=WORKSPACE_WALK_MAX_ENTRIES):
+    """Returns (entries, newest mtime) over a worktree's files and directories, or None if it has too many.
+
+    Editing, adding or removing a file changes the signature, so a repository whose
+    signature, refs and index are all unchanged can't have become dirty or clean.
+    .git and WORKSPACE_SKIP_DIRS (normally ignored anyway) are not walked.
+    """
+    count = 0
+    newest = 0
+    pending = [path]
+    while pending:
+        directory = pending.pop()
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    count += 1
+                    if count > max_entries:
+                        return None
+                    try:
+                        newest = max(newest, entry.stat(follow_symlinks=False).st_mtime_ns)
+                    except OSError:
+                        continue
+                    if entry.is_dir(follow_symlinks=False) and entry.name != ".git" \
+                            and entry.name not in WORKSPACE_SKIP_DIRS:
+                        pending.append(entry.path)
+        except OSError:
+            return None
+    return count, newest
+
+
+class WorkspaceScanner:
+    """Collects the status of many repositories, reusing results for those that haven't changed.
+
+    A repository counts as unchanged when HEAD, its refs and the index look the same
+    as last time (read through GitRepoReader), its worktree_signature hasn't moved
+    and its status is younger than WORKSPACE_STATUS_TTL. Worktrees too big to walk
+    are always asked about. scan_repository runs on worker threads.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._readers = {}
+        self._cache = {}  # path -> (fingerprint, monotonic time, RepoStatus)
+
+    def fingerprint(self, path):
+        reader = self._readers.get(path)
+        if reader is None:
+            reader = self._readers[path] = GitRepoReader(path)
+        if reader.git_dir is None:
+            return None
+        try:
+            index = os.stat(os.path.join(reader.git_dir, "index"))
+            index_key = (index.st_mtime_ns, index.st_size)
+        except OSError:
+            index_key = None
+        worktree = worktree_signature(path)
+        if worktree is None:
+            return None
+        return reader.ref_snapshot(), index_key, worktree
+
+    def scan_repository(self, path, force=False):
+        started = time.perf_counter()
+        fingerprint = self.fingerprint(path)
+        cached = self._cache.get(path)
+        if not force and fingerprint is not None and cached is not None and cached[0] == fingerprint \
+                and time.monotonic() - cached[1] < WORKSPACE_STATUS_TTL:
+            return WorkspaceEntry(path, cached[2], None, 0.0, True)
+
+        process = popen_git(status_args(), path, write=False, encoding="utf-8", errors="replace")
+        stdout, stderr = process.communicate()
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        perf_recorder.add("git status (workspace)", "git", started, elapsed_ms / 1000, size=len(stdout),
+                          returncode=process.returncode)
+        if process.returncode != 0:
+            self._cache.pop(path, None)
+            return WorkspaceEntry(path, None, stderr.strip() or f"git exited with {process.returncode}",
+                                  elapsed_ms, False)
+        status = parse_status_v2(stdout)
+        self._cache[path] = (fingerprint, time.monotonic(), status)
+        return WorkspaceEntry(path, status, None, elapsed_ms, False)
+
+
+# Bulk fetch/pull: repositories handled at once by default, and how often a transient failure is retried
+BATCH_PARALLELISM = 4
+BATCH_RETRIES = 2
+BATCH_RETRY_DELAY = 2.0
+BATCH_COMMANDS = {
+    "fetch": ["fetch", "--progress"],
+    # Never create merge commits behind the user's back across dozens of repositories
+    "pull": ["pull", "--progress", "--ff-only"],
+}
+# stderr fragments that mean trying again might work
+TRANSIENT_ERRORS = ("Could not resolve host", "Connection", "timed out", "early EOF", "unable to access",
+                    "RPC failed", "hung up unexpectedly", "Temporary failure")
+
+PROGRESS_LINE = re.compile(r"^(?:remote: )?([A-Za-z ]+):\s+(\d+)%")
+# Share of the overall bar each phase of a transfer gets: (start, width); remote-side phases share the first 10%
+PROGRESS_PHASES = {"Receiving objects": (10, 80), "Unpacking objects": (10, 80), "Resolving deltas": (90, 8),
+                   "Updating files": (98, 2)}
+
+BatchResult = namedtuple("BatchResult", "path ok attempts elapsed error")
+
+
+def parse_progress(line):
+    """Returns (phase, overall percent) for a git --progress line, or None."""
+    match = PROGRESS_LINE.match(line)
+    if not match:
+        return None
+    phase, percent = match.group(1).strip(), int(match.group(2))
+    start, width = PROGRESS_PHASES.get(phase, (0, 10))
+    return phase, start + percent * width // 100
+
+
+class BatchOperation:
+    """Runs one git command (fetch, pull) in many repositories, `parallelism` at a time.
+
+    Progress parsed from git's stderr is reported through on_progress(path, phase,
+    percent) and each outcome through on_done(BatchResult). Both are called on worker
+    threads. Failures that look like network trouble are retried with a growing delay.
+    """
+
+    def __init__(self, args, paths, parallelism=BATCH_PARALLELISM, retries=BATCH_RETRIES,
+                 retry_delay=BATCH_RETRY_DELAY, on_progress=None, on_done=None):
+        self.args = args
+        self.paths = list(paths)
+        self.parallelism = max(1, parallelism)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self._cancelled = threading.Event()
+        self._processes = set()
+        self._lock = threading.Lock()
+        self._pool = None
+        self._futures = []
+
+    def start(self):
+        self._pool = ThreadPoolExecutor(max_workers=self.parallelism, thread_name_prefix="git-batch")
+        self._futures = [self._pool.submit(self._run, path) for path in self.paths]
+        self._pool.shutdown(wait=False)
+        return self
+
+    def wait(self):
+        """Blocks until every repository is done and returns the BatchResults in order."""
+        return [future.result() for future in self._futures]
+
+    def cancel(self):
+        self._cancelled.set()
+        with self._lock:
+            for process in self._processes:
+                if process.poll() is None:
+                    process.terminate()
+
+    def _run(self, path):
+        started = time.perf_counter()
+        attempts = 0
+        while True:
+            attempts += 1
+            if self._cancelled.is_set():
+                returncode, error = None, "cancelled"
+            else:
+                returncode, error = self._run_once(path)
+            if returncode == 0 or self._cancelled.is_set() or attempts > self.retries \
+                    or not any(marker in error for marker in TRANSIENT_ERRORS):
+                break
+            self._progress(path, f"retry {attempts}/{self.retries}", 0)
+            self._cancelled.wait(self.retry_delay * attempts)
+        result = BatchResult(path, returncode == 0, attempts, time.perf_counter() - started,
+                             None if returncode == 0 else error)
+        if self.on_done is not None:
+            self.on_done(result)
+        return result
+
+    def _run_once(self, path):
+        started = time.perf_counter()
+        returncode, error = self._run_git(path)
+        perf_recorder.add(command_name(self.args) + " (batch)", "git", started, time.perf_counter() - started,
+                          returncode=returncode)
+        return returncode, error
+
+    def _run_git(self, path):
+        try:
+            # No terminal to answer credential prompts on, so fail instead of hanging
+            process = popen_git(self.args, path, extra_env={"GIT_TERMINAL_PROMPT": "0"},
+                                text=False, stdout=subprocess.DEVNULL)
+        except OSError as e:
+            return None, str(e)
+        with self._lock:
+            self._processes.add(process)
+        messages = deque(maxlen=20)  # Non-progress stderr lines, for the error report
+        buffer = b""
+        try:
+            while True:
+                chunk = process.stderr.read1(4096)
+                if not chunk:
+                    break
+                # Progress lines are redrawn with \r, everything else ends with \n
+                *lines, buffer = re.split(rb"[\r\n]", buffer + chunk)
+                for raw in lines:
+                    line = raw.decode("utf-8", errors="replace").strip()
+                    progress = parse_progress(line)
+                    if progress is not None:
+                        self._progress(path, *progress)
+                    elif line:
+                        messages.append(line)
+            process.wait()
+        finally:
+            process.stderr.close()
+            with self._lock:
+                self._processes.discard(process)
+        if buffer.strip():
+            messages.append(buffer.decode("utf-8", errors="replace").strip())
+        return process.returncode, "\n".join(messages)
+
+    def _progress(self, path, phase, percent):
+        if self.on_progress is not None:
+            self.on_progress(path, phase, percent)
+
+
+# Choices offered for `git clone --filter`; partial clones fetch the rest on demand
+CLONE_FILTERS = {
+    "Full clone": None,
+    "Blobless (--filter=blob:none)": "blob:none",
+    "Treeless (--filter=tree:0)": "tree:0",
+}
+SPARSE_PATTERN_CHARS = frozenset("*?[!\\")
+
+
+def clone_directory_name(url):
+    """Returns the directory name git would pick for a clone of `url`."""
+    name = url.rstrip("/").rsplit("/", 1)[-1].rsplit(":", 1)[-1]
+    if name.endswith(".git"):
+        name = name[:-4]
+    return name or "repository"
+
+
+def build_clone_args(url, directory, depth=None, filter_spec=None, branch=None, single_branch=False,
+                     sparse=False):
+    """Returns the `git clone` arguments for the given options, with progress reporting on."""
+    args = ["clone", "--progress"]
+    if depth:
+        args += ["--depth", str(depth)]
+    if filter_spec:
+        args.append(f"--filter={filter_spec}")
+    if branch:
+        args += ["--branch", branch]
+    if single_branch:
+        args.append("--single-branch")
+    elif depth:
+        # --depth implies --single-branch unless told otherwise
+        args.append("--no-single-branch")
+    if sparse:
+        args.append("--sparse")
+    return args + ["--", url, directory]
+
+
+def build_sparse_checkout_args(patterns):
+    """Returns `git sparse-checkout set` arguments; plain directories use the faster cone mode."""
+    cone = not any(SPARSE_PATTERN_CHARS & set(pattern) for pattern in patterns)
+    return ["sparse-checkout", "set", "--cone" if cone else "--no-cone", "--"] + list(patterns)
+
+
+# Local and remote-tracking branches, newest commit first: ref, object, commit time, "*" for HEAD,
+# upstream and subject, separated by \x1f
+BRANCH_FORMAT = "%(refname)%1f%(objectname)%1f%(committerdate:unix)%1f%(HEAD)%1f%(upstream:short)%1f%(contents:subject)"
+BRANCH_LIST_ARGS = ["for-each-ref", "--sort=-committerdate", "--format=" + BRANCH_FORMAT, "refs/heads/", "refs/remotes/"]
+# Branch names passed to one `git branch -d`; keeps well inside Windows' 32767-character command line
+BRANCH_DELETE_MAX_CHARS = 30000
+
+Branch = namedtuple("Branch", "name ref oid timestamp head upstream subject remote")
+
+
+def parse_branches(output):
+    """Parses BRANCH_LIST_ARGS output into Branches, skipping remotes' HEAD pointers."""
+    branches = []
+    for line in output.splitlines():
+        ref, oid, timestamp, head, upstream, subject = line.split("\x1f", 5)
+        remote = ref.startswith("refs/remotes/")
+        if remote and ref.endswith("/HEAD"):
+            continue
+        name = ref[len("refs/remotes/"):] if remote else ref[len("refs/heads/"):]
+        branches.append(Branch(name, ref, oid, int(timestamp or 0), head == "*", upstream, subject, remote))
+    return branches
+
+
+def read_branches(cwd):
+    """Returns every local and remote-tracking Branch, most recently committed first."""
+    return parse_branches(run_git_output(BRANCH_LIST_ARGS, cwd))
+
+
+def read_merged_branches(cwd, target="HEAD"):
+    """Returns the names of local branches whose tip is reachable from `target`."""
+    output = run_git_output(["for-each-ref", f"--merged={target}", "--format=%(refname:short)", "refs/heads/"], cwd)
+    return set(output.splitlines())
+
+
+def branch_delete_args(names, force=False, max_chars=BRANCH_DELETE_MAX_CHARS):
+    """Returns the `git branch -d` commands deleting `names`: one, unless the names don't fit on one command line."""
+    commands = []
+    batch, length = [], 0
+    for name in names:
+        if batch and length + len(name) + 1 > max_chars:
+            commands.append(batch)
+            batch, length = [], 0
+        batch.append(name)
+        length += len(name) + 1
+    if batch:
+        commands.append(batch)
+    return [["branch", "-D" if force else "-d", "--"] + batch for batch in commands]
+
+
+def run_git_output(args, cwd):
+    """Runs a read-only git command and returns stdout; raises RuntimeError with git's message on failure."""
+    process = popen_git(args, cwd, write=False, encoding="utf-8", errors="replace")
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(stderr.strip() or f"git {args[0]} exited with {process.returncode}")
+    return stdout
+
+
+def status_summary(status):
+    """Returns a RepoStatus as plain data for JSON output."""
+    return {
+        "branch": status.branch, "oid": status.oid, "upstream": status.upstream,
+        "ahead": status.ahead, "behind": status.behind, "staged": status.staged,
+        "unstaged": status.unstaged, "untracked": status.untracked, "conflicts": status.conflicts,
+    }
+
+
+def expand_repositories(paths):
+    """Returns (repositories, problems) for `paths`; a path that isn't a repository is searched for them.
+
+    `problems` maps each path that doesn't exist, or holds no repositories, to the reason.
+    """
+    repos = []
+    problems = {}
+    for path in paths:
+        path = os.path.abspath(path)
+        if os.path.exists(os.path.join(path, ".git")):
+            repos.append(path)
+        elif not os.path.isdir(path):
+            problems[path] = "no such directory"
+        else:
+            found = discover_repositories(path)
+            if not found:
+                problems[path] = "no git repositories found"
+            repos.extend(found)
+    return repos, problems
+
+
+def cli_status(options):
+    status = parse_status_v2(run_git_output(status_args(), options.repo))
+    if options.json:
+        summary = status_summary(status)
+        summary["entries"] = {path: xy for path, (_, xy) in status.entries.items()}
+        return summary
+    print(f"## {status.branch or '(unknown)'}" + (f"...{status.upstream} [ahead {status.ahead}, behind {status.behind}]"
+                                                 if status.upstream else ""))
+    for path, (_, xy) in sorted(status.entries.items()):
+        print(f"{xy} {path}")
+
+
+def cli_branches(options):
+    if options.all:
+        branches = read_branches(options.repo)
+        if options.json:
+            return [branch._asdict() for branch in branches]
+        for branch in branches:
+            date = time.strftime("%Y-%m-%d", time.localtime(branch.timestamp))
+            print(f"{'*' if branch.head else ' '} {branch.name:40} {date} {branch.subject}")
+        return
+    branches = GitRepoReader(options.repo).branches()
+    if branches is None:
+        output = run_git_output(["for-each-ref", "--format=%(refname:short)", "refs/heads/"], options.repo)
+        branches = sorted(output.splitlines())
+    if options.json:
+        return branches
+    print("\n".join(branches))
+
+
+def cli_log(options):
+    stream = GitOutputStream(["log", "--topo-order", "--all", "--format=" + HISTORY_FORMAT], options.repo)
+    try:
+        commits = [parse_commit_record(line) for line in stream.read_page(options.max_count)]
+    finally:
+        stream.close()
+    if options.json:
+        return [commit._asdict() for commit in commits]
+    for commit in commits:
+        date = time.strftime("%Y-%m-%d", time.localtime(int(commit.timestamp)))
+        print(f"{commit.hash[:10]} {date} {commit.author}: {commit.subject}")
+
+
+def cli_workspace(options):
+    if not os.path.isdir(options.root):
+        raise RuntimeError(f"{options.root}: no such directory")
+    scanner = WorkspaceScanner(options.root)
+    with ThreadPoolExecutor(WORKSPACE_WORKERS) as pool:
+        entries = list(pool.map(scanner.scan_repository, discover_repositories(options.root)))
+    if options.json:
+        return [dict(path=entry.path, error=entry.error, elapsed_ms=round(entry.elapsed_ms, 1),
+                     **(status_summary(entry.status) if entry.status else {})) for entry in entries]
+    for entry in entries:
+        name = os.path.relpath(entry.path, options.root)
+        if entry.error:
+            print(f"{name}: error: {entry.error}")
+        else:
+            status = entry.status
+            print(f"{name}: {status.branch} +{status.ahead}/-{status.behind}, {len(status.entries)} changed")
+
+
+def cli_batch(options):
+    def on_done(result):
+        if not options.json:
+            outcome = "ok" if result.ok else f"failed: {result.error}"
+            print(f"{result.path}: {outcome} ({result.elapsed:.1f} s, {result.attempts} attempt(s))", flush=True)
+
+    repos, problems = expand_repositories(options.paths)
+    results = [BatchResult(path, False, 0, 0.0, error) for path, error in problems.items()]
+    for result in results:
+        on_done(result)
+    results += BatchOperation(BATCH_COMMANDS[options.command], repos, parallelism=options.jobs,
+                              on_done=on_done).start().wait()
+    if options.json:
+        return [result._asdict() for result in results]
+    if not all(result.ok for result in results):
+        return 1
+
+
+def cli_clone(options):
+    url = options.url
+    directory = options.directory or clone_directory_name(url)
+    parent = os.path.dirname(os.path.abspath(directory))
+
+    def on_progress(path, phase, percent):
+        if not options.json:
+            print(f"\r{phase}: {percent}%".ljust(40), end="", file=sys.stderr, flush=True)
+
+    result, = BatchOperation(
+        build_clone_args(url, os.path.basename(os.path.abspath(directory)), depth=options.depth,
+                         filter_spec=options.filter, branch=options.branch,
+                         single_branch=options.single_branch, sparse=bool(options.sparse)),
+        [parent], parallelism=1, retries=0, on_progress=on_progress).start().wait()
+    if not options.json:
+        print(file=sys.stderr)
+    if result.ok and options.sparse:
+        process = popen_git(build_sparse_checkout_args(options.sparse), os.path.abspath(directory))
+        _, stderr = process.communicate()
+        if process.returncode != 0:
+            result = result._replace(ok=False, error=stderr.strip())
+    if options.json:
+        return result._asdict()
+    if not result.ok:
+        print(result.error, file=sys.stderr)
+        return 1
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="git_core", description="Git Bridge without the window.")
+    parser.add_argument("--json", action="store_true", help="print machine-readable JSON")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    for name, handler, description in (("status", cli_status, "show branch and changed files"),
+                                       ("branches", cli_branches, "list local branches"),
+                                       ("log", cli_log, "list commits from every branch")):
+        command = commands.add_parser(name, help=description)
+        command.add_argument("-C", dest="repo", default=os.getcwd(), help="repository (default: current directory)")
+        command.set_defaults(handler=handler)
+    commands.choices["log"].add_argument("-n", dest="max_count", type=int, default=HISTORY_PAGE_SIZE)
+    commands.choices["branches"].add_argument("-a", "--all", action="store_true",
+                                              help="include remote-tracking branches, newest commit first")
+
+    workspace = commands.add_parser("workspace", help="summarize every repository under a folder")
+    workspace.add_argument("root")
+    workspace.set_defaults(handler=cli_workspace)
+
+    for name in BATCH_COMMANDS:
+        batch = commands.add_parser(name, help=f"{name} many repositories in parallel")
+        batch.add_argument("paths", nargs="+", help="repositories, or folders to search for them")
+        batch.add_argument("-j", dest="jobs", type=int, default=BATCH_PARALLELISM)
+        batch.set_defaults(handler=cli_batch)
+
+    clone = commands.add_parser("clone", help="clone with optional depth, filter and sparse checkout")
+    clone.add_argument("url")
+    clone.add_argument("directory", nargs="?")
+    clone.add_argument("--depth", type=int)
+    clone.add_argument("--filter", choices=[spec for spec in CLONE_FILTERS.values() if spec])
+    clone.add_argument("--branch")
+    clone.add_argument("--single-branch", action="store_true")
+    clone.add_argument("--sparse", action="append", metavar="PATTERN", help="check out only these paths")
+    clone.set_defaults(handler=cli_clone)
+    return parser
+
+
+def main(argv=None):
+    options = build_parser().parse_args(argv)
+    try:
+        result = options.handler(options)
+    except (RuntimeError, OSError) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    if options.json:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+        # Fetch, pull and clone report each outcome as {"ok": ...}; any failure fails the run
+        outcomes = result if isinstance(result, list) else [result]
+        return 1 if any(isinstance(item, dict) and item.get("ok") is False for item in outcomes) else 0
+    return result or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,134 @@
+"""BatchOperation against local bare repositories: no network, no Tk.
+
+Run with `python -m pytest test_batch.py` or `python -m unittest test_batch`.
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import unittest
+
+from git_core import BATCH_COMMANDS, BatchOperation, PROGRESS_PHASES
+
+# Identity for the commits made here, so the tests don't depend on the user's git config
+GIT_ENV = dict(os.environ, GIT_AUTHOR_NAME="Test", GIT_AUTHOR_EMAIL="test@example.com",
+               GIT_COMMITTER_NAME="Test", GIT_COMMITTER_EMAIL="test@example.com")
+# Nothing listens on port 1, so fetching from here fails the way an unreachable server does
+UNREACHABLE_URL = "http://127.0.0.1:1/missing.git"
+
+
+def git(args, cwd):
+    return subprocess.run(["git"] + args, cwd=cwd, env=GIT_ENV, check=True,
+                          capture_output=True, text=True).stdout.strip()
+
+
+class BatchOperationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="gitbridge-test-")
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        remote = os.path.join(self.root, "remote.git")
+        git(["init", "-q", "--bare", remote], self.root)
+        # file:// makes git use its regular transport, which reports progress like a server would
+        self.url = "file://" + remote.replace(os.sep, "/")
+        self.author = self.clone("author")
+        self.commit(self.author, "first")
+        git(["push", "-q", "origin", "HEAD"], self.author)
+        self.clones = [self.clone(name) for name in ("one", "two")]
+        # New work on the remote that the clones don't have yet
+        self.commit(self.author, "second")
+        git(["push", "-q", "origin", "HEAD"], self.author)
+        self.remote_head = git(["rev-parse", "HEAD"], self.author)
+
+    def clone(self, name):
+        path = os.path.join(self.root, name)
+        git(["clone", "-q", self.url, path], self.root)
+        return path
+
+    def commit(self, repo, message):
+        with open(os.path.join(repo, "file.txt"), "a", encoding="utf-8") as f:
+            f.write(message + "\n")
+        git(["add", "file.txt"], repo)
+        git(["commit", "-q", "-m", message], repo)
+
+    def run_batch(self, command, paths, **kwargs):
+        progress = []
+        done = []
+        results = BatchOperation(BATCH_COMMANDS[command], paths, on_progress=lambda *args: progress.append(args),
+                                 on_done=done.append, **kwargs).start().wait()
+        self.assertEqual(sorted(done), sorted(results))
+        return results, progress
+
+    def test_fetch(self):
+        results, progress = self.run_batch("fetch", self.clones)
+        self.assertEqual([result.path for result in results], self.clones)
+        for result in results:
+            self.assertTrue(result.ok, result.error)
+            self.assertEqual(result.attempts, 1)
+            self.assertIsNone(result.error)
+            self.assertEqual(git(["rev-parse", "origin/HEAD"], result.path), self.remote_head)
+        # Progress is parsed from git's stderr; a fetch this small only gets the remote's phases,
+        # which share the first part of the bar
+        self.assertTrue(progress)
+        for path, phase, percent in progress:
+            self.assertIn(path, self.clones)
+            self.assertNotIn(phase, PROGRESS_PHASES)
+            self.assertTrue(0 <= percent <= 10)
+        self.assertIn((self.clones[0], "Counting objects", 10), progress)
+
+    def test_pull_fast_forwards(self):
+        results, _ = self.run_batch("pull", self.clones)
+        for result in results:
+            self.assertTrue(result.ok, result.error)
+            self.assertEqual(git(["rev-parse", "HEAD"], result.path), self.remote_head)
+
+    def test_pull_refuses_to_merge(self):
+        diverged = self.clones[0]
+        self.commit(diverged, "local")
+        results, _ = self.run_batch("pull", self.clones)
+        self.assertFalse(results[0].ok)
+        self.assertEqual(results[0].attempts, 1)  # Not a network problem, so not retried
+        self.assertTrue(results[1].ok, results[1].error)
+
+    def test_unreachable_remote_is_retried(self):
+        broken = self.clones[0]
+        git(["remote", "set-url", "origin", UNREACHABLE_URL], broken)
+        results, progress = self.run_batch("fetch", self.clones, retries=2, retry_delay=0)
+        self.assertFalse(results[0].ok)
+        self.assertEqual(results[0].attempts, 3)
+        self.assertIn("unable to access", results[0].error)
+        self.assertIn((broken, "retry 1/2", 0), progress)
+        self.assertIn((broken, "retry 2/2", 0), progress)
+        self.assertTrue(results[1].ok, results[1].error)
+
+    def test_cancel_before_start(self):
+        operation = BatchOperation(BATCH_COMMANDS["fetch"], self.clones)
+        operation.cancel()
+        for result in operation.start().wait():
+            self.assertFalse(result.ok)
+            self.assertEqual(result.error, "cancelled")
+        self.assertNotEqual(git(["rev-parse", "origin/HEAD"], self.clones[0]), self.remote_head)
+
+    def test_cancel_during_retry_delay(self):
+        git(["remote", "set-url", "origin", UNREACHABLE_URL], self.clones[0])
+        retrying = threading.Event()
+
+        def on_progress(path, phase, percent):
+            if phase.startswith("retry"):
+                retrying.set()
+
+        # Without the cancel this would wait a minute before trying again
+        operation = BatchOperation(BATCH_COMMANDS["fetch"], self.clones[:1], retries=5, retry_delay=60,
+                                   on_progress=on_progress).start()
+        self.assertTrue(retrying.wait(30))
+        operation.cancel()
+        result, = operation.wait()
+        self.assertFalse(result.ok)
+        self.assertEqual(result.error, "cancelled")
+        self.assertLess(result.elapsed, 30)
+
+
+if __name__ == "__main__":
+    unittest.main()